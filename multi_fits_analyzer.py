@@ -1,24 +1,393 @@
 import astropy.io.fits as fits
 import matplotlib.pyplot as plt
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import pandas as pd
-from scipy.ndimage import gaussian_filter
+from PIL import Image as PILImage, ImageDraw, ImageFont
+from scipy.ndimage import gaussian_filter1d, uniform_filter
+from scipy.signal import fftconvolve
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import os
+import tempfile
+
+try:
+    import fitsio
+except ImportError:
+    fitsio = None
+
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
+try:
+    import numba
+    from numba import njit, prange
+except ImportError:
+    numba = None
+    njit = None
 
 # =================================================================
 # SISTEMA AVANZADO PICASER: ANÁLISIS MULTI-TEMPORAL DE IMÁGENES FITS
 # Investigadora Principal: Pilar López Giménez
 # =================================================================
 
-def analizador_multitemporal_picaser(fits_file_paths):
+def box_blur_approx(img, sigma=15, passes=3):
+    """
+    Aproximación de un suavizado gaussiano mediante filtros de caja iterados.
+
+    Cada pasada de uniform_filter cuesta lo mismo por píxel sea cual sea sigma;
+    tres pasadas dan una respuesta prácticamente gaussiana. El ancho se fuerza
+    a impar para que la caja quede centrada y no desplace la imagen.
+    """
+    w = int(round(sigma * np.sqrt(12.0 / passes)))
+    w |= 1
+    suavizado = img
+    for _ in range(passes):
+        suavizado = uniform_filter(suavizado, size=w)
+    return suavizado
+
+def filtro_gaussiano_separable(img, sigma=15, truncate=3.0):
+    """
+    Suavizado gaussiano aplicado como dos pasadas 1-D (filas y columnas).
+
+    Con truncate=3.0 el núcleo 1-D baja de ~121 a ~91 coeficientes para
+    sigma=15, sin diferencia apreciable en el fondo que se resta.
+    """
+    suavizado = gaussian_filter1d(img, sigma, axis=0, truncate=truncate)
+    return gaussian_filter1d(suavizado, sigma, axis=1, truncate=truncate)
+
+def filtro_gaussiano_fft(img, sigma=15, truncate=4.0):
+    """
+    Suavizado gaussiano exacto mediante convolución FFT, en dos pasadas 1-D.
+
+    Los bordes se rellenan por reflexión (el modo 'reflect' de scipy.ndimage) y se usa el
+    modo 'valid', de modo que el resultado tiene la forma de la imagen original
+    sin el oscurecimiento que produciría el relleno con ceros.
+    """
+    radio = int(truncate * sigma + 0.5)
+    x = np.arange(-radio, radio + 1, dtype=np.float32)
+    k = np.exp(-(x ** 2) / np.float32(2 * sigma ** 2))
+    k /= k.sum()
+
+    relleno = np.pad(img, radio, mode='symmetric')
+    suavizado = fftconvolve(relleno, k[:, None], mode='valid', axes=0)
+    return fftconvolve(suavizado, k[None, :], mode='valid', axes=1)
+
+# Métodos disponibles para estimar el fondo que el Filtro Picaser resta
+METODOS_SUAVIZADO = {
+    'caja': box_blur_approx,
+    'separable': filtro_gaussiano_separable,
+    'fft': filtro_gaussiano_fft,
+}
+
+# Núcleo gaussiano fijo del Filtro Picaser (sigma=15, truncado a 3 sigma: 91
+# coeficientes). Numba trata estas globales como constantes al compilar.
+SIGMA_PICASER = 15
+RADIO_NUCLEO_PICASER = 3 * SIGMA_PICASER
+NUCLEO_PICASER = np.exp(-np.arange(-RADIO_NUCLEO_PICASER, RADIO_NUCLEO_PICASER + 1) ** 2
+                        / (2.0 * SIGMA_PICASER ** 2)).astype(np.float32)
+NUCLEO_PICASER /= NUCLEO_PICASER.sum()
+TAPS_NUCLEO_PICASER = len(NUCLEO_PICASER)
+
+# Los núcleos con prange arrancan el pool de hilos de Numba, y hacer fork de un
+# proceso con ese pool activo lo cuelga (TBB) o lo mata (OpenMP). Por eso solo
+# se usan en los procesos del pool de comparaciones, que no vuelven a hacer
+# fork; el proceso principal usa la versión compilada en serie.
+_en_proceso_del_pool = False
+
+def _iniciar_proceso_pool(max_workers):
+    """
+    Inicializa cada proceso del pool de comparaciones: activa los núcleos
+    paralelos y reparte los núcleos de la máquina entre los procesos, para que
+    los hilos de Numba y numexpr de todos ellos no superen a los núcleos.
+    """
+    global _en_proceso_del_pool
+    _en_proceso_del_pool = True
+
+    hilos = max(1, (os.cpu_count() or 1) // max(1, max_workers))
+    if numba is not None:
+        numba.set_num_threads(min(hilos, numba.config.NUMBA_NUM_THREADS))
+    if ne is not None:
+        ne.set_num_threads(hilos)
+
+if njit is not None:
+    def _convolucion_separable(relleno):
+        alto = relleno.shape[0] - 2 * RADIO_NUCLEO_PICASER
+        ancho = relleno.shape[1] - 2 * RADIO_NUCLEO_PICASER
+
+        # Pasada horizontal sobre todas las filas (también las del relleno)
+        filas = np.empty((relleno.shape[0], ancho), dtype=np.float32)
+        for i in prange(relleno.shape[0]):
+            for j in range(ancho):
+                acumulado = np.float32(0.0)
+                for t in range(TAPS_NUCLEO_PICASER):
+                    acumulado += NUCLEO_PICASER[t] * relleno[i, j + t]
+                filas[i, j] = acumulado
+
+        # Pasada vertical: el bucle interno recorre la fila de forma contigua
+        suavizado = np.zeros((alto, ancho), dtype=np.float32)
+        for i in prange(alto):
+            for t in range(TAPS_NUCLEO_PICASER):
+                peso = NUCLEO_PICASER[t]
+                for j in range(ancho):
+                    suavizado[i, j] += peso * filas[i + t, j]
+        return suavizado
+
+    _convolucion_separable_paralela = njit(parallel=True, fastmath=True, cache=True)(_convolucion_separable)
+    # Sin cache: compartiría la entrada de caché de la versión paralela
+    _convolucion_separable_serie = njit(fastmath=True)(_convolucion_separable)
+
+    def filtro_gaussiano_numba(img, sigma=SIGMA_PICASER):
+        """
+        Suavizado gaussiano separable compilado con Numba para el sigma fijo del
+        Filtro Picaser. Los bordes se rellenan por reflexión, como en scipy.ndimage.
+        Solo es paralelo dentro de los procesos del pool (ver _iniciar_proceso_pool).
+        """
+        if sigma != SIGMA_PICASER:
+            raise ValueError(f"El núcleo de Numba está compilado para sigma={SIGMA_PICASER} (recibido {sigma}).")
+        relleno = np.pad(img.astype(np.float32, copy=False), RADIO_NUCLEO_PICASER, mode='symmetric')
+        if _en_proceso_del_pool:
+            return _convolucion_separable_paralela(relleno)
+        return _convolucion_separable_serie(relleno)
+
+    METODOS_SUAVIZADO['numba'] = filtro_gaussiano_numba
+
+def _validar_imagen(naxis, path):
+    """
+    Comprueba que el HDU primario contiene una imagen 2-D (NAXIS=2). Es habitual
+    que el primario esté vacío y la imagen esté en una extensión; sin esta
+    comprobación el análisis seguiría con un array vacío o escalar sin avisar.
+    Se valida con el número de ejes para no tener que decodificar los datos.
+    """
+    if naxis == 0:
+        raise ValueError(f"El HDU primario de '{path}' no contiene datos.")
+    if naxis != 2:
+        raise ValueError(f"El HDU primario de '{path}' no es una imagen 2-D (NAXIS={naxis}).")
+
+def cargar_datos_fits(path, region=None):
+    """
+    Carga el HDU primario de un archivo FITS como array float32.
+
+    Usa fitsio (cfitsio) cuando está instalado, por ser bastante más rápido que
+    astropy en lecturas simples de imagen; si no está disponible o falla la
+    lectura, recurre a astropy. En ambos casos el archivo queda cerrado al volver.
+
+    Args:
+        path (str): Ruta del archivo FITS.
+        region (tuple, optional): (slice de filas, slice de columnas). Si se indica,
+                                  solo se leen esos píxeles del archivo.
+    """
+    if fitsio is not None:
+        try:
+            if region is None:
+                datos = fitsio.read(path, ext=0)
+            else:
+                # cfitsio lee únicamente las filas y columnas pedidas
+                with fitsio.FITS(path) as fits_file:
+                    datos = fits_file[0][region]
+            _validar_imagen(0 if datos is None else datos.ndim, path)
+            datos = datos.astype(np.float32, copy=False)
+            if datos.size == 0:
+                raise ValueError(f"La región {region} no contiene píxeles de '{path}'.")
+            return datos
+        except Exception:
+            # astropy vuelve a intentarlo y da el error definitivo si lo hay
+            pass
+
+    # astropy mapea el archivo en memoria siempre que puede (no con BZERO/BSCALE,
+    # p. ej. imágenes uint16, que lee igualmente); el bloque with cierra el
+    # archivo aunque haya muchas comparaciones. La validación usa solo la
+    # cabecera, para no decodificar el HDU entero cuando se pide una región.
+    with fits.open(path) as hdul:
+        _validar_imagen(hdul[0].header.get('NAXIS', 0), path)
+        if region is None:
+            return np.array(hdul[0].data, dtype=np.float32)
+        datos = np.array(hdul[0].section[region], dtype=np.float32)
+
+    # Una región fuera de la imagen da un array vacío
+    if datos.size == 0:
+        raise ValueError(f"La región {region} no contiene píxeles de '{path}'.")
+    return datos
+
+def diferencial_picaser(now_clean, past_clean):
+    """
+    Calcula el mapa diferencial y el umbral de detección (5 sigma).
+
+    El diferencial se escribe sobre el buffer de past_clean, que ya no se
+    necesita, para no reservar otra imagen completa.
+    """
+    diferencial = np.subtract(now_clean, past_clean, out=past_clean)
+    np.abs(diferencial, out=diferencial)
+    return diferencial, np.std(diferencial) * 5
+
+if njit is not None:
+    def _clasificar_numba(diferencial, umbral):
+        alto, ancho = diferencial.shape
+
+        # Primera pasada: cuántas detecciones hay en cada fila
+        conteos = np.zeros(alto, dtype=np.int64)
+        for y in prange(alto):
+            c = 0
+            for x in range(ancho):
+                if diferencial[y, x] > umbral:
+                    c += 1
+            conteos[y] = c
+
+        inicios = np.zeros(alto + 1, dtype=np.int64)
+        inicios[1:] = np.cumsum(conteos)
+        n = inicios[alto]
+
+        ys = np.empty(n, dtype=np.int64)
+        xs = np.empty(n, dtype=np.int64)
+        magnitudes = np.empty(n, dtype=diferencial.dtype)
+        prometedores = np.empty(n, dtype=np.bool_)
+        umbral_prometedor = umbral * 3
+
+        # Segunda pasada: cada fila escribe en su tramo, en el mismo orden que np.nonzero
+        for y in prange(alto):
+            k = inicios[y]
+            for x in range(ancho):
+                valor = diferencial[y, x]
+                if valor > umbral:
+                    ys[k] = y
+                    xs[k] = x
+                    magnitudes[k] = valor
+                    prometedores[k] = valor > umbral_prometedor
+                    k += 1
+
+        return ys, xs, magnitudes, prometedores
+
+    # Igual que en el suavizado: la versión paralela solo dentro del pool
+    _clasificar_numba_paralela = njit(parallel=True, cache=True)(_clasificar_numba)
+    # Sin cache: compartiría la entrada de caché de la versión paralela
+    _clasificar_numba_serie = njit(_clasificar_numba)
+else:
+    _clasificar_numba = None
+
+def clasificar_detecciones(diferencial, umbral):
+    """
+    Localiza los píxeles por encima del umbral.
+
+    Returns:
+        tuple: (ys, xs, magnitudes, prometedores), donde 'prometedores' es una
+               máscara booleana de las detecciones que superan 3 veces el umbral.
+    """
+    if _clasificar_numba is not None:
+        if _en_proceso_del_pool:
+            return _clasificar_numba_paralela(diferencial, umbral)
+        return _clasificar_numba_serie(diferencial, umbral)
+
+    if ne is not None:
+        mascara = ne.evaluate("diferencial > umbral",
+                              local_dict={'diferencial': diferencial, 'umbral': umbral})
+    else:
+        mascara = diferencial > umbral
+    ys, xs = np.nonzero(mascara)
+    magnitudes = diferencial[ys, xs]
+    return ys, xs, magnitudes, magnitudes > (umbral * 3)
+
+def _procesar_comparacion(now_clean, reference_path, comparison_path, i, firma, metodo_suavizado='caja',
+                          region=None):
+    """
+    Compara un archivo FITS con la referencia ya limpia. Se ejecuta en un
+    proceso del pool, por lo que cualquier error se devuelve en el resultado.
+    """
+    print(f"\n📡 Comparando '{reference_path}' con '{comparison_path}'...")
+    comparison_result = {
+        'reference_file': reference_path,
+        'comparison_file': comparison_path,
+        'diferencial': None,
+        'lista_total': pd.DataFrame(),
+        'lista_prometedores': pd.DataFrame(),
+        'error': None
+    }
+
+    try:
+        data_comparacion = cargar_datos_fits(comparison_path, region)
+
+        # 2. ALINEACIÓN BÁSICA Y LIMPIEZA (Filtro Picaser)
+        # Limpiamos el ruido de la comparación para comparar solo "señal pura"
+        suavizado = METODOS_SUAVIZADO[metodo_suavizado]
+        past_clean = data_comparacion - suavizado(data_comparacion, sigma=15)
+
+        # 3. GENERACIÓN DEL DIFERENCIAL (La "Resta Mágica")
+        # Lo que sea 0 es que no ha cambiado. Lo que sea > 0 es NUEVO o se ha MOVIDO.
+        diferencial, umbral = diferencial_picaser(now_clean, past_clean)
+
+        # 4. CLASIFICACIÓN DE RESULTADOS
+        # Un resultado es "Prometedor" si la intensidad es muy alta
+        ys, xs, intensidades, prometedores = clasificar_detecciones(diferencial, umbral)
+
+        # Se construyen las columnas completas con NumPy en lugar de fila a fila.
+        # El redondeo se hace en float64: en float32 no caben 2 decimales exactos.
+        df_total = pd.DataFrame({
+            'ID': [f"Picaser-Diff-{i}-{k}" for k in range(1, len(xs) + 1)],
+            'Coord_X': xs,
+            'Coord_Y': ys,
+            'Magnitud_Cambio': np.round(intensidades.astype(np.float64), 2),
+            'Prometedor': prometedores,
+            'Firma': firma
+        })
+        df_prometedores = df_total[prometedores].sort_values(by='Magnitud_Cambio', ascending=False)
+
+        comparison_result['diferencial'] = diferencial
+        comparison_result['lista_total'] = df_total
+        comparison_result['lista_prometedores'] = df_prometedores
+        print(f"✅ Comparación con '{comparison_path}' completada. Se detectaron {len(df_total)} cambios.")
+
+    except Exception as e:
+        comparison_result['error'] = f"Error durante la comparación con {comparison_path}: {e}"
+        print(f"❌ {comparison_result['error']}")
+
+    return comparison_result
+
+def _procesar_comparacion_compartida(ref_compartida, *args):
+    """
+    Punto de entrada de los procesos del pool: reconstruye la referencia limpia
+    como vista (sin copia) sobre la memoria compartida y llama a
+    _procesar_comparacion.
+
+    Args:
+        ref_compartida (tuple): (nombre del bloque compartido, forma, dtype).
+    """
+    nombre, forma, dtype = ref_compartida
+    shm = shared_memory.SharedMemory(name=nombre)
+    try:
+        now_clean = np.ndarray(forma, dtype=dtype, buffer=shm.buf)
+        comparison_result = _procesar_comparacion(now_clean, *args)
+        del now_clean
+    finally:
+        shm.close()
+    return comparison_result
+
+def analizador_multitemporal_picaser(fits_file_paths, max_workers=None, metodo_suavizado='caja',
+                                    region=None):
     """
     Realiza un análisis diferencial temporal comparando un archivo FITS de referencia
     con una lista de archivos FITS posteriores.
 
+    Las comparaciones son independientes entre sí y se reparten entre varios
+    procesos; los resultados se devuelven en el mismo orden que las rutas.
+
     Args:
         fits_file_paths (list): Una lista de rutas a archivos FITS. El primer archivo
                                  se usa como referencia, los demás se comparan con él.
+        max_workers (int, optional): Número máximo de procesos. Por defecto, uno por
+                                     núcleo (sin superar el número de comparaciones).
+        metodo_suavizado (str, optional): Clave de METODOS_SUAVIZADO usada para estimar
+                                          el fondo: 'caja' (aproximación rápida, por
+                                          defecto), 'separable' (gaussiana de scipy
+                                          truncada a 3 sigma), 'fft' (gaussiana exacta)
+                                          o 'numba' (gaussiana compilada, si numba está
+                                          instalado).
+        region (tuple, optional): (slice de filas, slice de columnas) a comparar, p. ej.
+                                  (slice(y0, y1), slice(x0, x1)). Solo se leen esos
+                                  píxeles de cada archivo y las coordenadas de los
+                                  resultados son relativas a la región. Por defecto,
+                                  la imagen completa.
 
     Returns:
         list: Una lista de diccionarios, donde cada diccionario contiene:
@@ -35,79 +404,115 @@ def analizador_multitemporal_picaser(fits_file_paths):
         print("❌ Se necesitan al menos dos archivos FITS para el análisis multitemporal.")
         return all_comparisons_results
 
+    if metodo_suavizado not in METODOS_SUAVIZADO:
+        print(f"❌ Método de suavizado desconocido '{metodo_suavizado}'. Opciones: {', '.join(METODOS_SUAVIZADO)}.")
+        return all_comparisons_results
+
     reference_path = fits_file_paths[0]
     try:
-        data_referencia = fits.open(reference_path)[0].data.astype(float)
+        data_referencia = cargar_datos_fits(reference_path, region)
         print(f"✅ Archivo de referencia cargado: {reference_path}")
     except Exception as e:
         print(f"❌ Error al cargar el archivo de referencia {reference_path}: {e}")
         return all_comparisons_results
 
-    for i in range(1, len(fits_file_paths)):
-        comparison_path = fits_file_paths[i]
-        print(f"\n📡 Comparando '{reference_path}' con '{comparison_path}'...")
-        comparison_result = {
-            'reference_file': reference_path,
-            'comparison_file': comparison_path,
-            'diferencial': None,
-            'lista_total': pd.DataFrame(),
-            'lista_prometedores': pd.DataFrame(),
-            'error': None
-        }
-
-        try:
-            data_comparacion = fits.open(comparison_path)[0].data.astype(float)
-
-            # 2. ALINEACIÓN BÁSICA Y LIMPIEZA (Filtro Picaser)
-            # Limpiamos el ruido de ambas para comparar solo "señal pura"
-            now_clean = data_referencia - gaussian_filter(data_referencia, sigma=15)
-            past_clean = data_comparacion - gaussian_filter(data_comparacion, sigma=15)
+    # 2. LIMPIEZA DE LA REFERENCIA (Filtro Picaser)
+    # La referencia no cambia entre comparaciones: se limpia una sola vez y se
+    # escribe directamente en memoria compartida, para que los procesos la lean
+    # sin recibir una copia cada uno.
+    shm = None
+    try:
+        fondo_referencia = METODOS_SUAVIZADO[metodo_suavizado](data_referencia, sigma=15)
+        shm = shared_memory.SharedMemory(create=True, size=data_referencia.nbytes)
+        now_clean = np.ndarray(data_referencia.shape, dtype=data_referencia.dtype, buffer=shm.buf)
+        np.subtract(data_referencia, fondo_referencia, out=now_clean)
+    except Exception as e:
+        print(f"❌ Error al limpiar el archivo de referencia {reference_path}: {e}")
+        # La vista debe liberarse antes de cerrar el bloque compartido
+        now_clean = None
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+        return all_comparisons_results
 
-            # 3. GENERACIÓN DEL DIFERENCIAL (La "Resta Mágica")
-            # Lo que sea 0 es que no ha cambiado. Lo que sea > 0 es NUEVO o se ha MOVIDO.
-            diferencial = np.abs(now_clean - past_clean)
+    ref_compartida = (data_referencia.shape, data_referencia.dtype.str)
+    try:
+        # La vista debe liberarse antes de cerrar el bloque compartido
+        del data_referencia, fondo_referencia, now_clean
+
+        comparison_paths = fits_file_paths[1:]
+        if max_workers is None:
+            max_workers = min(os.cpu_count() or 1, len(comparison_paths))
+
+        # La firma de autoría se calcula una vez para todo el análisis
+        firma = f"PLG-{datetime.now().year}"
+
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_iniciar_proceso_pool,
+                                 initargs=(max_workers,)) as executor:
+            futures = [executor.submit(_procesar_comparacion_compartida, (shm.name,) + ref_compartida,
+                                       reference_path, comparison_path, i, firma, metodo_suavizado, region)
+                       for i, comparison_path in enumerate(comparison_paths, start=1)]
+
+            for comparison_path, future in zip(comparison_paths, futures):
+                try:
+                    all_comparisons_results.append(future.result())
+                except Exception as e:
+                    # Fallos del propio pool (proceso caído, datos no serializables...)
+                    error = f"Error durante la comparación con {comparison_path}: {e}"
+                    print(f"❌ {error}")
+                    all_comparisons_results.append({
+                        'reference_file': reference_path,
+                        'comparison_file': comparison_path,
+                        'diferencial': None,
+                        'lista_total': pd.DataFrame(),
+                        'lista_prometedores': pd.DataFrame(),
+                        'error': error
+                    })
+    finally:
+        shm.close()
+        shm.unlink()
 
-            umbral = np.std(diferencial) * 5
-            puntos = np.where(diferencial > umbral)
+    return all_comparisons_results
 
-            resultados = []
+# Tamaño de cada píxel del zoom en la imagen final y alto de la franja del título
+ESCALA_LUPA = 10
+ALTO_TITULO_LUPA = 40
 
-            # 4. CLASIFICACIÓN DE RESULTADOS
-            for j in range(len(puntos[0])):
-                y, x = puntos[0][j], puntos[1][j]
-                intensidad = diferencial[y, x]
+_cmap_lupa = None
 
-                # Un resultado es "Prometedor" si la intensidad es muy alta
-                es_prometedor = "SÍ" if intensidad > (umbral * 3) else "No"
+def _render_lupa(tarea):
+    """
+    Guarda una Lupa Picaser como PNG. Se ejecuta en un proceso del pool.
 
-                resultados.append({
-                    'ID': f"Picaser-Diff-{i}-{j+1}",
-                    'Coord_X': x,
-                    'Coord_Y': y,
-                    'Magnitud_Cambio': round(intensidad, 2),
-                    'Prometedor': es_prometedor,
-                    'Firma': f"PLG-{datetime.now().year}"
-                })
+    El zoom se colorea directamente con el colormap 'inferno' y se escribe con
+    PIL, con una franja de título encima; así se evita crear una figura de
+    matplotlib por candidato.
+    """
+    global _cmap_lupa
+    zoom_diff, candidate_id, ref_name, comp_name, filename = tarea
 
-            df_total = pd.DataFrame(resultados)
-            df_prometedores = df_total[df_total['Prometedor'] == "SÍ"].sort_values(by='Magnitud_Cambio', ascending=False)
+    if _cmap_lupa is None:
+        _cmap_lupa = plt.get_cmap('inferno')
 
-            comparison_result['diferencial'] = diferencial
-            comparison_result['lista_total'] = df_total
-            comparison_result['lista_prometedores'] = df_prometedores
-            print(f"✅ Comparación con '{comparison_path}' completada. Se detectaron {len(df_total)} cambios.")
+    # Misma normalización min-max que aplicaría imshow
+    minimo, maximo = float(zoom_diff.min()), float(zoom_diff.max())
+    rango = maximo - minimo
+    norm = (zoom_diff - minimo) / rango if rango > 0 else np.zeros_like(zoom_diff)
+    rgb = (_cmap_lupa(norm)[..., :3] * 255).astype(np.uint8)
 
-        except Exception as e:
-            comparison_result['error'] = f"Error durante la comparación con {comparison_path}: {e}"
-            print(f"❌ {comparison_result['error']}")
-        finally:
-            all_comparisons_results.append(comparison_result)
+    zoom = PILImage.fromarray(rgb)
+    zoom = zoom.resize((zoom.width * ESCALA_LUPA, zoom.height * ESCALA_LUPA), PILImage.NEAREST)
 
-    return all_comparisons_results
+    lupa = PILImage.new('RGB', (zoom.width, zoom.height + ALTO_TITULO_LUPA), 'white')
+    lupa.paste(zoom, (0, ALTO_TITULO_LUPA))
+    ImageDraw.Draw(lupa).multiline_text((5, 5), f"HALLAZGO {candidate_id}\n({ref_name} vs {comp_name})",
+                                        fill='black', font=ImageFont.load_default())
+    lupa.save(filename, optimize=False, compress_level=1)
+    return filename
 
-def generate_picaser_lupas(all_comparisons_results):
+def generate_picaser_lupas(all_comparisons_results, max_workers=None, directorio_imagenes='.'):
     print("Generando visualizaciones detalladas de 'Lupa Picaser' para cada candidato prometedor...")
-    lupa_picaser_filenames = []
+    tareas = []
 
     for comp_idx, comparison_result in enumerate(all_comparisons_results):
         if comparison_result['error']:
@@ -127,32 +532,52 @@ def generate_picaser_lupas(all_comparisons_results):
 
         print(f"Procesando {len(lista_prometedores_current)} candidatos prometedores para la comparación {comp_idx+1}: {ref_name} vs {comp_name}")
 
-        for index, row in lista_prometedores_current.iterrows():
-            x, y = int(row['Coord_X']), int(row['Coord_Y'])
-            candidate_id = row['ID']
-
-            # Calcula la región de zoom, asegurando que los límites estén dentro de la imagen
-            zoom_diff = diferencial_current[max(0, y-15):min(diferencial_current.shape[0], y+15),
-                                            max(0, x-15):min(diferencial_current.shape[1], x+15)]
-
-            plt.figure(figsize=(4, 4))
-            plt.imshow(zoom_diff, cmap='inferno')
-            plt.title(f"HALLAZGO {candidate_id}\n({ref_name} vs {comp_name})")
-            plt.axis('off')
+        # Extrae todas las regiones de zoom de una vez: la ventana 30x30 que empieza
+        # en (y, x) de la imagen rellenada está centrada en (y, x) de la original.
+        # El relleno por reflexión mantiene el tamaño también junto a los bordes.
+        diferencial_rellenado = np.pad(diferencial_current, 15, mode='reflect')
+        ventanas = sliding_window_view(diferencial_rellenado, (30, 30))
+        zooms = ventanas[lista_prometedores_current['Coord_Y'].to_numpy(),
+                         lista_prometedores_current['Coord_X'].to_numpy()]
 
+        for zoom_diff, candidate_id in zip(zooms, lista_prometedores_current['ID']):
             # Crear un nombre de archivo único incluyendo el índice de comparación y los nombres de los archivos
-            filename = f'lupa_picaser_comp{comp_idx+1}_{ref_name}_vs_{comp_name}_{candidate_id}.png'
-            plt.savefig(filename)
-            plt.close() # Cierra la figura para liberar memoria
+            filename = os.path.join(directorio_imagenes, f'lupa_picaser_comp{comp_idx+1}_{ref_name}_vs_{comp_name}_{candidate_id}.png')
+            tareas.append((zoom_diff, candidate_id, ref_name, comp_name, filename))
 
-            lupa_picaser_filenames.append(filename)
-            # print(f"  ✅ '{filename}' guardado con éxito.")
+    # Cada lupa es independiente: se reparten entre varios procesos
+    lupa_picaser_filenames = []
+    if tareas:
+        # Con fork todos los procesos arrancan a la vez: no más que bloques de 16 lupas
+        if max_workers is None:
+            max_workers = min(os.cpu_count() or 1, -(-len(tareas) // 16))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            lupa_picaser_filenames = list(executor.map(_render_lupa, tareas, chunksize=16))
 
     print("Todas las visualizaciones de 'Lupa Picaser' han sido generadas y guardadas.")
     return lupa_picaser_filenames
 
-def generate_multi_comparison_pdf(all_comparisons_results, lupa_picaser_filenames, pdf_output_filename="Informe_Picaser_MultiComparacion.pdf"):
-    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image, Table, TableStyle
+def formatear_detecciones(df):
+    """
+    Copia de un DataFrame de detecciones lista para el informe: la columna
+    booleana 'Prometedor' se muestra como "SÍ"/"No".
+    """
+    if 'Prometedor' not in df.columns:
+        return df
+    return df.assign(Prometedor=np.where(df['Prometedor'], "SÍ", "No"))
+
+def generate_multi_comparison_pdf(all_comparisons_results, lupa_picaser_filenames, pdf_output_filename="Informe_Picaser_MultiComparacion.pdf",
+                                  max_filas_tabla=1000, directorio_imagenes='.'):
+    """
+    Genera el informe PDF con una sección por comparación.
+
+    La lista completa de cambios de cada comparación se guarda además como CSV
+    junto al PDF; en el informe solo se incluyen sus primeras max_filas_tabla
+    filas (None para incluirlas todas), en tablas que se reparten entre páginas.
+    Los mapas diferenciales se escriben, y las lupas se buscan, en
+    directorio_imagenes.
+    """
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image, LongTable, TableStyle
     from reportlab.lib.pagesizes import inch, LETTER
     from reportlab.lib.styles import getSampleStyleSheet
     from reportlab.lib import colors
@@ -181,103 +606,123 @@ def generate_multi_comparison_pdf(all_comparisons_results, lupa_picaser_filename
         ('GRID', (0, 0), (-1, -1), 1, colors.black)
     ])
 
-    for comp_idx, comparison_result in enumerate(all_comparisons_results):
-        if comparison_result['error']:
-            story_multi.append(Paragraph(f"<br/><br/><b>ERROR en Comparación {comp_idx+1}: {os.path.basename(comparison_result['reference_file'])} vs {os.path.basename(comparison_result['comparison_file'])}</b>", styles['h2']))
-            story_multi.append(Paragraph(f"<i>{comparison_result['error']}</i>", styles['Normal']))
-            story_multi.append(Spacer(1, 0.2 * inch))
-            continue
-
-        ref_name = os.path.basename(comparison_result['reference_file']).replace('.FITS', '')
-        comp_name = os.path.basename(comparison_result['comparison_file']).replace('.FITS', '')
-
-        story_multi.append(Paragraph(f"<br/><br/><b>SECCIÓN {comp_idx+1}: {ref_name} vs {comp_name}</b>", styles['h2']))
-        story_multi.append(Spacer(1, 0.1 * inch))
+    # Una única figura para todos los mapas diferenciales; se cierra al final,
+    # también si falla alguna sección
+    fig_mapa = plt.figure(figsize=(15, 10))
 
-        # Genera y guarda el mapa diferencial principal para esta comparación
-        mapa_diferencial_filename = f'mapa_diferencial_comp{comp_idx+1}_{ref_name}_vs_{comp_name}.png'
+    try:
+        for comp_idx, comparison_result in enumerate(all_comparisons_results):
+            if comparison_result['error']:
+                story_multi.append(Paragraph(f"<br/><br/><b>ERROR en Comparación {comp_idx+1}: {os.path.basename(comparison_result['reference_file'])} vs {os.path.basename(comparison_result['comparison_file'])}</b>", styles['h2']))
+                story_multi.append(Paragraph(f"<i>{comparison_result['error']}</i>", styles['Normal']))
+                story_multi.append(Spacer(1, 0.2 * inch))
+                continue
 
-        plt.figure(figsize=(15, 10))
-        plt.imshow(comparison_result['diferencial'], cmap='viridis', origin='lower')
-        plt.title(f"MAPA DE DIFERENCIAS TEMPORALES\n({ref_name} vs {comp_name})")
-        plt.colorbar(label='Grado de Cambio')
+            ref_name = os.path.basename(comparison_result['reference_file']).replace('.FITS', '')
+            comp_name = os.path.basename(comparison_result['comparison_file']).replace('.FITS', '')
+
+            story_multi.append(Paragraph(f"<br/><br/><b>SECCIÓN {comp_idx+1}: {ref_name} vs {comp_name}</b>", styles['h2']))
+            story_multi.append(Spacer(1, 0.1 * inch))
+
+            # Genera y guarda el mapa diferencial principal para esta comparación
+            mapa_diferencial_filename = os.path.join(directorio_imagenes, f'mapa_diferencial_comp{comp_idx+1}_{ref_name}_vs_{comp_name}.png')
+
+            # Se reutiliza la misma figura: basta con limpiarla antes de dibujar
+            fig_mapa.clf()
+            ax_mapa = fig_mapa.add_subplot()
+            # Una imagen de varios megapíxeles no se distingue en el PDF de una
+            # submuestreada a ~2000 px de lado. extent conserva las coordenadas
+            # originales (para los círculos de los candidatos) y vmin/vmax la escala
+            # de color completa.
+            diferencial_current = comparison_result['diferencial']
+            paso = max(1, max(diferencial_current.shape) // 2000)
+            alto, ancho = diferencial_current.shape
+            im_mapa = ax_mapa.imshow(diferencial_current[::paso, ::paso], cmap='viridis', origin='lower',
+                                     interpolation='nearest', extent=(-0.5, ancho - 0.5, -0.5, alto - 0.5),
+                                     vmin=diferencial_current.min(), vmax=diferencial_current.max(),
+                                     rasterized=True)
+            ax_mapa.set_title(f"MAPA DE DIFERENCIAS TEMPORALES\n({ref_name} vs {comp_name})")
+            fig_mapa.colorbar(im_mapa, ax=ax_mapa, label='Grado de Cambio')
+
+            lista_prometedores_current = comparison_result['lista_prometedores']
+            if not lista_prometedores_current.empty:
+                sizes = lista_prometedores_current['Magnitud_Cambio'] / lista_prometedores_current['Magnitud_Cambio'].max() * 500
+                ax_mapa.scatter(lista_prometedores_current['Coord_X'], lista_prometedores_current['Coord_Y'],
+                                s=sizes, edgecolors='red', facecolors='none', linewidth=1.5,
+                                label='Candidato Prometedor (Tamaño = Magnitud de Cambio)', alpha=0.8)
+                ax_mapa.legend()
+            ax_mapa.set_xlabel("Coordenada X")
+            ax_mapa.set_ylabel("Coordenada Y")
+            fig_mapa.savefig(mapa_diferencial_filename)
+
+            if os.path.exists(mapa_diferencial_filename):
+                available_width = LETTER[0] - 2 * inch
+                available_height = LETTER[1] - 3 * inch
+                img_mapa_comp = Image(mapa_diferencial_filename, width=available_width, height=available_height)
+                story_multi.append(Paragraph("<b>Mapa de Diferencias Temporales</b>", styles['h3']))
+                story_multi.append(img_mapa_comp)
+                story_multi.append(Spacer(1, 0.2 * inch))
+            else:
+                story_multi.append(Paragraph(f"<i>Error: Imagen '{mapa_diferencial_filename}' no encontrada.</i>", styles['Normal']))
+
+            story_multi.append(Paragraph("<b>Lista Completa de Cambios Detectados</b>", styles['h3']))
+
+            # La lista completa va a un CSV junto al PDF; en el informe puede recortarse
+            lista_total_current = formatear_detecciones(comparison_result['lista_total'])
+            csv_filename = f'detecciones_comp{comp_idx+1}_{ref_name}_vs_{comp_name}.csv'
+            lista_total_current.to_csv(os.path.join(os.path.dirname(pdf_output_filename), csv_filename), index=False)
+            story_multi.append(Paragraph(f"<i>Lista completa ({len(lista_total_current)} cambios) disponible en <a href=\"{csv_filename}\">{csv_filename}</a>.</i>", styles['Normal']))
+            if max_filas_tabla is not None and len(lista_total_current) > max_filas_tabla:
+                story_multi.append(Paragraph(f"<i>Se muestran los primeros {max_filas_tabla} cambios.</i>", styles['Normal']))
+                lista_total_current = lista_total_current.head(max_filas_tabla)
+            story_multi.append(Spacer(1, 0.1 * inch))
+
+            data_total_for_pdf = [lista_total_current.columns.values.tolist()] + lista_total_current.values.tolist()
+            t_total = LongTable(data_total_for_pdf, repeatRows=1)
+            t_total._width = LETTER[0] - 2 * inch
+            if data_total_for_pdf and data_total_for_pdf[0]: # Check if there are columns
+                col_widths = [(LETTER[0] - 2 * inch) / len(data_total_for_pdf[0])] * len(data_total_for_pdf[0])
+                t_total._argW = col_widths
+            t_total.setStyle(table_style)
+            story_multi.append(t_total)
+            story_multi.append(Spacer(1, 0.2 * inch))
 
-        lista_prometedores_current = comparison_result['lista_prometedores']
-        if not lista_prometedores_current.empty:
-            sizes = lista_prometedores_current['Magnitud_Cambio'] / lista_prometedores_current['Magnitud_Cambio'].max() * 500
-            plt.scatter(lista_prometedores_current['Coord_X'], lista_prometedores_current['Coord_Y'],
-                        s=sizes, edgecolors='red', facecolors='none', linewidth=1.5,
-                        label='Candidato Prometedor (Tamaño = Magnitud de Cambio)', alpha=0.8)
-            plt.legend()
-        plt.xlabel("Coordenada X")
-        plt.ylabel("Coordenada Y")
-        plt.savefig(mapa_diferencial_filename)
-        plt.close() # Cerrar la figura para liberar memoria
-
-        if os.path.exists(mapa_diferencial_filename):
-            available_width = LETTER[0] - 2 * inch
-            available_height = LETTER[1] - 3 * inch
-            img_mapa_comp = Image(mapa_diferencial_filename, width=available_width, height=available_height)
-            story_multi.append(Paragraph("<b>Mapa de Diferencias Temporales</b>", styles['h3']))
-            story_multi.append(img_mapa_comp)
+            story_multi.append(Paragraph("<b>Candidatos Picaser de Alta Prioridad</b>", styles['h3']))
+            tabla_prometedores = formatear_detecciones(lista_prometedores_current)
+            data_prometedores_for_pdf = [tabla_prometedores.columns.values.tolist()] + tabla_prometedores.values.tolist()
+            t_prometedores = LongTable(data_prometedores_for_pdf, repeatRows=1)
+            t_prometedores._width = LETTER[0] - 2 * inch
+            if data_prometedores_for_pdf and data_prometedores_for_pdf[0]:
+                col_widths = [(LETTER[0] - 2 * inch) / len(data_prometedores_for_pdf[0])] * len(data_prometedores_for_pdf[0])
+                t_prometedores._argW = col_widths
+            t_prometedores.setStyle(table_style)
+            story_multi.append(t_prometedores)
             story_multi.append(Spacer(1, 0.2 * inch))
-        else:
-            story_multi.append(Paragraph(f"<i>Error: Imagen '{mapa_diferencial_filename}' no encontrada.</i>", styles['Normal']))
-
-        story_multi.append(Paragraph("<b>Lista Completa de Cambios Detectados</b>", styles['h3']))
-        data_total_for_pdf = [comparison_result['lista_total'].columns.values.tolist()] + comparison_result['lista_total'].values.tolist()
-        t_total = Table(data_total_for_pdf)
-        t_total._width = LETTER[0] - 2 * inch
-        if data_total_for_pdf and data_total_for_pdf[0]: # Check if there are columns
-            col_widths = [(LETTER[0] - 2 * inch) / len(data_total_for_pdf[0])] * len(data_total_for_pdf[0])
-            t_total._argW = col_widths
-        t_total.setStyle(table_style)
-        story_multi.append(t_total)
-        story_multi.append(Spacer(1, 0.2 * inch))
-
-        story_multi.append(Paragraph("<b>Candidatos Picaser de Alta Prioridad</b>", styles['h3']))
-        data_prometedores_for_pdf = [lista_prometedores_current.columns.values.tolist()] + lista_prometedores_current.values.tolist()
-        t_prometedores = Table(data_prometedores_for_pdf)
-        t_prometedores._width = LETTER[0] - 2 * inch
-        if data_prometedores_for_pdf and data_prometedores_for_pdf[0]:
-            col_widths = [(LETTER[0] - 2 * inch) / len(data_prometedores_for_pdf[0])] * len(data_prometedores_for_pdf[0])
-            t_prometedores._argW = col_widths
-        t_prometedores.setStyle(table_style)
-        story_multi.append(t_prometedores)
-        story_multi.append(Spacer(1, 0.2 * inch))
-
-        story_multi.append(Paragraph("<b>Vistas Detalladas de Lupa Picaser</b>", styles['h3']))
-
-        for index, row in lista_prometedores_current.iterrows():
-            candidate_id = row['ID']
-            # Construye el nombre del archivo de la lupa basado en cómo se guardó previamente
-            lupa_filename = f'lupa_picaser_comp{comp_idx+1}_{ref_name}_vs_{comp_name}_{candidate_id}.png'
-
-            if os.path.exists(lupa_filename):
-                story_multi.append(Paragraph(f"<i>Candidato: {candidate_id} - Intensidad: {row['Magnitud_Cambio']:.2f}</i>", styles['Normal']))
-                img_lupa_comp = Image(lupa_filename, width=3*inch, height=3*inch)
-                story_multi.append(img_lupa_comp)
-                story_multi.append(Spacer(1, 0.1 * inch))
-            else:
-                story_multi.append(Paragraph(f"<i>Error: Imagen '{lupa_filename}' no encontrada para el candidato {candidate_id}.</i>", styles['Normal']))
+
+            story_multi.append(Paragraph("<b>Vistas Detalladas de Lupa Picaser</b>", styles['h3']))
+
+            for index, row in lista_prometedores_current.iterrows():
+                candidate_id = row['ID']
+                # Construye el nombre del archivo de la lupa basado en cómo se guardó previamente
+                lupa_filename = os.path.join(directorio_imagenes, f'lupa_picaser_comp{comp_idx+1}_{ref_name}_vs_{comp_name}_{candidate_id}.png')
+
+                if os.path.exists(lupa_filename):
+                    story_multi.append(Paragraph(f"<i>Candidato: {candidate_id} - Intensidad: {row['Magnitud_Cambio']:.2f}</i>", styles['Normal']))
+                    # La lupa lleva la franja del título encima: se respeta su proporción
+                    with PILImage.open(lupa_filename) as lupa:
+                        ancho_lupa, alto_lupa = lupa.size
+                    img_lupa_comp = Image(lupa_filename, width=3*inch, height=3*inch * alto_lupa / ancho_lupa)
+                    story_multi.append(img_lupa_comp)
+                    story_multi.append(Spacer(1, 0.1 * inch))
+                else:
+                    story_multi.append(Paragraph(f"<i>Error: Imagen '{lupa_filename}' no encontrada para el candidato {candidate_id}.</i>", styles['Normal']))
+    finally:
+        plt.close(fig_mapa) # Cerrar la figura aunque falle alguna sección
 
     doc_multi.build(story_multi)
 
     print(f"✅ Informe PDF '{pdf_output_filename}' generado con éxito.")
 
-def cleanup_temporary_files(lupa_files, map_files, pdf_file):
-    print("Limpiando archivos temporales...")
-    all_temp_files = list(lupa_files) + list(map_files)
-    for f in all_temp_files:
-        if os.path.exists(f):
-            os.remove(f)
-            # print(f"Removed: {f}")
-    # Optionally remove the PDF if there was an error, but usually we want to keep it.
-    # if os.path.exists(pdf_file) and error_occurred_during_pdf_gen:
-    #     os.remove(pdf_file)
-    print("✅ Limpieza de archivos temporales completada.")
-
-
 if __name__ == "__main__":
     # 1. Entrada de Archivos FITS Interactiva
     fits_file_paths_input = []
@@ -312,20 +757,11 @@ if __name__ == "__main__":
         all_comparisons_results = analizador_multitemporal_picaser(fits_file_paths_input)
         print("\nAnálisis multitemporal completado.\n")
 
-        # 3. Generar imágenes de Lupa Picaser
-        lupa_picaser_filenames = generate_picaser_lupas(all_comparisons_results)
-
-        # 4. Generar el informe PDF multi-comparación
+        # 3. Generar imágenes de Lupa Picaser y 4. el informe PDF multi-comparación
+        # Las imágenes PNG son temporales: se escriben en un directorio temporal
+        # (en memoria si /tmp es tmpfs) que se borra solo al terminar.
         final_pdf_name = "Informe_Picaser_MultiComparacion_Final.pdf"
-        generate_multi_comparison_pdf(all_comparisons_results, lupa_picaser_filenames, final_pdf_name)
-
-        # 5. Recopilar nombres de los mapas diferenciales generados para limpieza
-        mapa_diferencial_filenames = []
-        for comp_idx, comparison_result in enumerate(all_comparisons_results):
-            if not comparison_result['error']:
-                ref_name = os.path.basename(comparison_result['reference_file']).replace('.FITS', '')
-                comp_name = os.path.basename(comparison_result['comparison_file']).replace('.FITS', '')
-                mapa_diferencial_filenames.append(f'mapa_diferencial_comp{comp_idx+1}_{ref_name}_vs_{comp_name}.png')
-
-        # 6. Limpiar archivos temporales (imágenes PNG)
-        cleanup_temporary_files(lupa_picaser_filenames, mapa_diferencial_filenames, final_pdf_name)
+        with tempfile.TemporaryDirectory() as directorio_temporal:
+            lupa_picaser_filenames = generate_picaser_lupas(all_comparisons_results, directorio_imagenes=directorio_temporal)
+            generate_multi_comparison_pdf(all_comparisons_results, lupa_picaser_filenames, final_pdf_name,
+                                          directorio_imagenes=directorio_temporal)